@@ -1,17 +1,229 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import re
 from calendar import monthrange
 import io
 
+# --- Lookup Tables and Patterns Shared by the Processing Logic and the UI ---
+# Defined once here so the helpers and the UI below use the same tables and compiled patterns.
+_MONTHS = ('january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december')
+_MONTH_NUM = {name: num for num, name in enumerate(_MONTHS, 1)}
+_MONTH_YEAR_RE = re.compile(rf"({'|'.join(_MONTHS)})\s+(\d{{4}})", re.IGNORECASE)
+
+# Determine Header Row Based on Sheet Name. According to your rules:
+# 'Duty - Senior': Header is on the 4th row (skip 3 rows).
+# 'Duty_MO', 'Duty - Part time': Header is on the 3rd row (skip 2 rows).
+_HEADER_ROW_MAP = {
+    "Duty - Senior": 3,
+    "Duty_MO": 2,
+    "Duty - Part time": 2
+}
+# Default to skipping 2 rows if sheet name is not standard
+_DEFAULT_SKIPROWS = 2
+
+# Requirement 3 & 4: Define patterns for non-name headers.
+# Simplified based on "no numbers", "not single letter", and new exclusions.
+# Short abbreviations only exclude a header when they appear as a whole word, so names
+# that merely contain them (e.g. 'Sam' and 'am', 'Alice' and 'ic') are not dropped.
+_EXACT_NON_NAMES = frozenset({
+    'am', 'pm', 'ic', 'ae', 'aw', 'pw', 'rat', 'ac', 'rs', 'rt', 'smo', 'cons', 'emw', 'new',
+    'sur', 'ort', 'qeh', 'mo', # Added 'qeh' and 'mo' for robustness
+    'fm', # Added 'fm'
+})
+# Longer words still exclude a header wherever they appear in it
+_NON_NAME_PATTERNS = [
+    r'unnamed', r'week', r'day', r'consultant', r'specialist',
+    r'final call', r'part-time', r'locum', r'full', r'half', r'total',
+    r'leave', r'intern', r'rotation', r'diir', r'visiting dr',
+    r'fall', r'shift',
+    r'ortho' # Added 'ortho'
+]
+# A single alternation scans each header once instead of once per pattern;
+# it also excludes any header that contains a digit
+_NON_NAME_RE = re.compile('|'.join([r'\d'] + _NON_NAME_PATTERNS))
+_WORD_RE = re.compile(r'[a-z]+')
+
+# --- Cached Excel Parsing ---
+# The caches are keyed on the uploaded file's bytes and live in server memory, so keep only
+# a few recent uploads (and the results derived from them) and let them expire.
+_MAX_CACHED_WORKBOOKS = 4
+_MAX_CACHED_RESULTS = 32
+_CACHE_TTL = 3600  # seconds
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_CACHED_WORKBOOKS, ttl=_CACHE_TTL)
+def _load_workbook(file_bytes: bytes) -> dict[str, pd.DataFrame]:
+    """
+    Parses every sheet of the workbook once, without a header row.
+
+    Cached on the raw file bytes so Streamlit reruns reuse the parsed sheets
+    instead of decompressing and parsing the XLSX again.
+    """
+    with pd.ExcelFile(io.BytesIO(file_bytes), engine='calamine') as xls:
+        return {sheet: xls.parse(sheet, header=None) for sheet in xls.sheet_names}
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_CACHED_WORKBOOKS, ttl=_CACHE_TTL)
+def _get_duty_sheets(file_bytes: bytes) -> list[tuple[str, int]]:
+    """
+    Returns (sheet_name, skiprows) for every duty sheet of the workbook.
+
+    Sheet names come from the cached workbook, so listing sheets, finding names and building
+    the calendar all share a single parse of the upload.
+    """
+    # Requirement 1: Filter sheet names to only include those with "Duty"
+    return [(name, _HEADER_ROW_MAP.get(name, _DEFAULT_SKIPROWS)) for name in _load_workbook(file_bytes) if "Duty" in name]
+
+
+def _header_names(values):
+    """
+    Names header cells the same way `pd.read_excel` does: empty cells become
+    'Unnamed: <position>' and repeated names get a '.1', '.2', ... suffix.
+    """
+    header = [f"Unnamed: {position}" if pd.isna(value) else value for position, value in enumerate(values)]
+    seen = {}
+    for position, name in enumerate(header):
+        count = seen.get(name, 0)
+        if count:
+            original = name
+            # Skip suffixes already taken by another header, e.g. 'Ken', 'Ken', 'Ken.1'
+            # becomes 'Ken', 'Ken.2', 'Ken.1'
+            while count:
+                seen[original] = count + 1
+                name = f"{original}.{count}"
+                count = count + 1 if name in header else seen.get(name, 0)
+        header[position] = name
+        seen[name] = count + 1
+    return header
+
+
+def _sheet_with_header(raw, skiprows, duty_column_name=None):
+    """
+    Slices a header-less sheet so that row `skiprows` becomes the column header.
+
+    If `duty_column_name` is given, only the first two (week/day) columns and that
+    column are kept, so the remaining columns are never copied out of the cached sheet.
+    A sheet that ends before its header row gives an empty DataFrame, like `pd.read_excel` does.
+    """
+    if len(raw) <= skiprows:
+        return pd.DataFrame()
+
+    header = _header_names(raw.iloc[skiprows])
+    if duty_column_name is None:
+        usecols = list(range(len(header)))
+    else:
+        usecols = [0, 1] + [position for position, name in enumerate(header) if position > 1 and name == duty_column_name]
+
+    df = raw.iloc[skiprows + 1:, usecols].reset_index(drop=True).infer_objects()
+    df.columns = [header[position] for position in usecols]
+    return df
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_CACHED_RESULTS, ttl=_CACHE_TTL)
+def _get_duty_names(file_bytes: bytes, sheet_name: str, skiprows: int) -> list:
+    """Returns the header columns of the sheet that look like staff names."""
+    # Requirement 2: Take potential names from the header row of the *selected sheet*.
+    # This ensures names are specific to the chosen sheet. The row is taken from the cached workbook
+    # and named by _header_names, exactly like the columns _build_calendar looks up.
+    raw = _load_workbook(file_bytes)[sheet_name]
+    # A sheet that ends before its header row (e.g. an empty template sheet) has no names
+    if len(raw) <= skiprows:
+        return []
+    header = _header_names(raw.iloc[skiprows])
+
+    # Rosters have a few dozen header columns and this result is cached per sheet, so pandas string
+    # ops are plenty here. If sheets ever grow to thousands of columns, the mask below is the part
+    # to move into a compiled (e.g. Numba) classifier over an encoded byte array of the headers.
+    # Filter out columns that are not names, all headers at once:
+    # single letters, anything matching a non-name pattern (which also covers digits and
+    # unnamed columns) and anything containing a non-name abbreviation as a word
+    cols = pd.Series(header, dtype=object)
+    col_lower = cols.astype(str).str.lower().str.strip()
+    keep = (
+        (col_lower.str.len() > 1)
+        & ~col_lower.str.contains(_NON_NAME_RE)
+        & col_lower.str.findall(_WORD_RE).map(_EXACT_NON_NAMES.isdisjoint).astype(bool)
+    )
+    return cols[keep].tolist()
+
 # --- Helper Function to Process the Data ---
-def process_roster(file_bytes, sheet_name, duty_column_name, filename):
+class _RosterError(Exception):
+    """Raised when a sheet cannot be turned into a calendar; the message is shown to the user."""
+
+
+def _extract_month_year(filename: str) -> tuple[int, int, str, str] | None:
+    """Returns (year, month, month_name, year_str) taken from the filename, or None if it has none."""
+    match = _MONTH_YEAR_RE.search(filename)
+    if not match:
+        return None
+
+    month_name, year_str = match.groups()
+    return int(year_str), _MONTH_NUM[month_name.lower()], month_name, year_str
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_CACHED_RESULTS, ttl=_CACHE_TTL)
+def _build_calendar(file_bytes: bytes, sheet_name: str, skiprows: int, duty_column_name: str, year: int, month: int) -> pd.DataFrame:
+    """
+    Builds the calendar DataFrame for one person from the cached workbook.
+
+    Free of Streamlit side effects so the result can be cached: problems with the sheet
+    are raised as `_RosterError`, and a person without any duty gets an empty DataFrame.
+    """
+    # --- 2. Read and Clean the Specific Excel Sheet ---
+    # The workbook is parsed once and cached; only the columns needed for this person
+    # are sliced off the cached sheet
+    df = _sheet_with_header(_load_workbook(file_bytes)[sheet_name], skiprows, duty_column_name)
+
+    # Rename first two columns to be consistent
+    df.rename(columns={df.columns[0]: "week", df.columns[1]: "day"}, inplace=True)
+
+    # Check if the selected duty column exists
+    if duty_column_name not in df.columns:
+        raise _RosterError(f"Error: Column '{duty_column_name}' not found in the sheet '{sheet_name}'.")
+
+    # Keep only the essential columns
+    df = df[["day", duty_column_name]]
+
+    # --- 3. Filter and Process the Roster ---
+    # Remove rows where the 'day' is not a day number (handles extra text/empty rows).
+    # The column is parsed once; days fit in int8, so out-of-range numbers are dropped rather than wrapped.
+    days = pd.to_numeric(df['day'], errors='coerce')
+    mask = days.between(1, 31)
+    df = df.loc[mask].copy()
+    df['day'] = days[mask].astype(np.int8)
+
+    # VERY IMPORTANT: Remove days where the person has no duty (handles empty cells)
+    df.dropna(subset=[duty_column_name], inplace=True)
+
+    if df.empty:
+        return pd.DataFrame(columns=['Subject', 'Start Date', 'All Day Event'])
+
+    # Find the first row where the day is '1' to handle mid-month starts in the sheet
+    is_day_one = df['day'].to_numpy() == 1
+    if not is_day_one.any():
+        raise _RosterError("Could not find the start of the month (Day 1) in the sheet. Please check the 'day' column.")
+    df = df.iloc[is_day_one.argmax():]
+
+    # --- 4. Generate Dates and Create Final DataFrame ---
+    # Create the final DataFrame for export in a single construction
+    return pd.DataFrame({
+        # The subject should not contain the name of the person
+        'Subject': df[duty_column_name].astype(str).to_numpy(),
+        # Create the date for each duty day
+        'Start Date': (f"{year}-{month:02d}-" + df['day'].astype(str).str.zfill(2)).to_numpy(),
+        'All Day Event': 'True',
+    })
+
+
+def process_roster(file_bytes, sheet_info, duty_column_name, filename):
     """
     Processes the uploaded Excel file bytes to generate a calendar CSV.
 
     Args:
-        file_bytes (BytesIO): The Excel file uploaded by the user.
-        sheet_name (str): The name of the sheet to process.
+        file_bytes (bytes): The raw bytes of the Excel file uploaded by the user.
+        sheet_info (tuple): (sheet_name, skiprows) of the sheet to process, as listed by _get_duty_sheets.
         duty_column_name (str): The name of the person/column to extract duty for.
         filename (str): The original name of the uploaded file.
 
@@ -20,82 +232,31 @@ def process_roster(file_bytes, sheet_name, duty_column_name, filename):
         tuple: (month_name, year_str) if successful, otherwise None.
     """
     # --- 1. Extract Month and Year from Filename ---
-    match = re.search(r'(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{4})', filename, re.IGNORECASE)
-    if not match:
+    date_info = _extract_month_year(filename)
+    if date_info is None:
         st.error(f"Error: Could not find a month and year in the filename '{filename}'.")
         st.info("Please ensure the filename is formatted like 'Duty August 2025.xlsx'.")
         return None, None
 
-    month_name, year_str = match.groups()
-    year = int(year_str)
-    month_map = {name.lower(): num for num, name in enumerate(['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December'], 1)}
-    month = month_map[month_name.lower()]
-
-    # --- 2. Determine Header Row Based on Sheet Name ---
-    # According to your rules:
-    # 'Duty - Senior': Header is on the 4th row (skip 3 rows).
-    # 'Duty_MO', 'Duty - Part time': Header is on the 3rd row (skip 2 rows).
-    header_row_map = {
-        "Duty - Senior": 3,
-        "Duty_MO": 2,
-        "Duty - Part time": 2
-    }
-    # Default to skipping 2 rows if sheet name is not standard
-    skiprows = header_row_map.get(sheet_name, 2)
+    year, month, month_name, year_str = date_info
+    sheet_name, skiprows = sheet_info
 
     try:
-        # --- 3. Read and Clean the Specific Excel Sheet ---
-        df = pd.read_excel(file_bytes, sheet_name=sheet_name, skiprows=skiprows)
-
-        # Rename first two columns to be consistent
-        df.rename(columns={df.columns[0]: "week", df.columns[1]: "day"}, inplace=True)
-
-        # Check if the selected duty column exists
-        if duty_column_name not in df.columns:
-            st.error(f"Error: Column '{duty_column_name}' not found in the sheet '{sheet_name}'.")
-            return None, None
-
-        # Keep only the essential columns
-        df = df[["day", duty_column_name]]
-
-        # --- 4. Filter and Process the Roster ---
-        # Remove rows where the 'day' is not a number (handles extra text/empty rows)
-        df = df[pd.to_numeric(df['day'], errors='coerce').notna()]
-        df['day'] = df['day'].astype(int)
-
-        # VERY IMPORTANT: Remove days where the person has no duty (handles empty cells)
-        df.dropna(subset=[duty_column_name], inplace=True)
-        
-        if df.empty:
-            st.warning(f"No duties found for '{duty_column_name}' in the selected sheet.")
-            return None, None
-
-        # Find the first row where the day is '1' to handle mid-month starts in the sheet
-        try:
-            start_index = df[df['day'] == 1].index[0]
-            df = df.loc[start_index:]
-        except IndexError:
-            st.error("Could not find the start of the month (Day 1) in the sheet. Please check the 'day' column.")
-            return None, None
-
-        # --- 5. Generate Dates and Create Final DataFrame ---
-        # Create the final DataFrame for export
-        calendar_df = pd.DataFrame()
-        # The subject should not contain the name of the person
-        calendar_df['Subject'] = df[duty_column_name].astype(str)
-        
-        # Create the date for each duty day
-        calendar_df['Start Date'] = df['day'].apply(lambda day: f"{year}-{month:02d}-{day:02d}")
-        
-        calendar_df['All Day Event'] = 'True'
-
-        return calendar_df, (month_name, year_str)
-
+        calendar_df = _build_calendar(file_bytes, sheet_name, skiprows, duty_column_name, year, month)
+    except _RosterError as e:
+        st.error(str(e))
+        return None, None
     except Exception as e:
         st.error(f"An unexpected error occurred while processing the Excel file: {e}")
         st.info("Please ensure the file is not corrupted and the sheet format is correct.")
         return None, None
 
+    if calendar_df.empty:
+        st.warning(f"No duties found for '{duty_column_name}' in the selected sheet.")
+        return None, None
+
+    return calendar_df, (month_name, year_str)
+
 
 # --- Streamlit Web App UI ---
 
@@ -111,82 +272,35 @@ uploaded_file = st.file_uploader("Choose an XLSX file", type="xlsx")
 
 # --- App Logic: Proceeds only if a file is uploaded ---
 if uploaded_file is not None:
-    # Use io.BytesIO to handle the uploaded file in memory
-    file_bytes = io.BytesIO(uploaded_file.getvalue())
+    # Keep the raw bytes: they are hashable, so they double as the key for the cached parsing helpers.
+    # They are only wrapped in an io.BytesIO inside _load_workbook, the single reader of the upload.
+    raw_bytes = uploaded_file.getvalue()
     
     # Extract Month and Year from Filename here for use in output filename
-    match = re.search(r'(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{4})', uploaded_file.name, re.IGNORECASE)
-    if not match:
+    date_info = _extract_month_year(uploaded_file.name)
+    if date_info is None:
         st.error(f"Error: Could not find a month and year in the filename '{uploaded_file.name}'.")
         st.info("Please ensure the filename is formatted like 'Duty August 2025.xlsx'.")
         st.stop() # Stop execution if filename is incorrect
 
-    filename_month_name, filename_year_str = match.groups()
+    _, _, filename_month_name, filename_year_str = date_info
     
     try:
-        xls = pd.ExcelFile(file_bytes)
-        all_sheet_names = xls.sheet_names
+        duty_sheets = _get_duty_sheets(raw_bytes)
 
-        # Requirement 1: Filter sheet names to only include those with "Duty"
-        filtered_sheet_names = [name for name in all_sheet_names if "Duty" in name]
-        
-        if not filtered_sheet_names:
+        if not duty_sheets:
             st.error("No sheets containing 'Duty' found in the uploaded file. Please check your sheet names.")
             st.stop()
 
         # --- Step 2: Sheet Selection ---
         st.header("Step 2: Select the Duty Sheet")
-        selected_sheet = st.selectbox("Which sheet contains the duty roster?", filtered_sheet_names)
-
-        if selected_sheet:
-            # Determine header row to read the names correctly
-            header_row_map = {"Duty - Senior": 3, "Duty_MO": 2, "Duty - Part time": 2}
-            skiprows = header_row_map.get(selected_sheet, 2)
-            
-            # Requirement 2: Read just the header row from the *selected sheet* to get potential names.
-            # This ensures names are specific to the chosen sheet.
-            df_for_cols = pd.read_excel(file_bytes, sheet_name=selected_sheet, skiprows=skiprows, nrows=0)
-            
-            # Requirement 3 & 4: Define patterns for non-name headers.
-            # Simplified based on "no numbers", "not single letter", and new exclusions.
-            non_name_patterns = [
-                r'unnamed', r'week', r'day', r'am', r'pm', r'consultant', r'specialist',
-                r'final call', r'part-time', r'locum', r'full', r'half', r'total',
-                r'ic', r'ae', r'aw', r'pw', r'rat', r'leave', r'ac',
-                r'intern', r'rs', r'rt', r'smo', r'cons', r'emw', r'new',
-                r'rotation', r'sur', r'ort', r'diir', r'visiting dr',
-                r'fall', r'shift', r'qeh', r'mo', # Added 'qeh' and 'mo' for robustness
-                r'fm', # Added 'fm'
-                r'ortho' # Added 'ortho'
-            ]
-            
-            # Filter out columns that are not names
-            duty_names = []
-            for col in df_for_cols.columns:
-                col_lower = str(col).lower().strip()
-                
-                # Exclude if it's an unnamed column
-                if 'unnamed' in col_lower:
-                    continue
-                
-                # Exclude if it's a single letter
-                if len(col_lower) == 1:
-                    continue
-                
-                # Exclude if it contains a digit
-                if any(char.isdigit() for char in col_lower):
-                    continue
-                
-                # Exclude if it matches any non-name pattern
-                is_non_name = False
-                for pattern in non_name_patterns:
-                    if re.search(pattern, col_lower):
-                        is_non_name = True
-                        break
-                if is_non_name:
-                    continue
-                
-                duty_names.append(col)
+        sheet_info = st.selectbox("Which sheet contains the duty roster?", duty_sheets, format_func=lambda info: info[0])
+
+        if sheet_info:
+            # The header row to read the names correctly comes along with the sheet name
+            selected_sheet, skiprows = sheet_info
+
+            duty_names = _get_duty_names(raw_bytes, selected_sheet, skiprows)
 
             if not duty_names:
                 st.error(f"Could not find any staff names in the sheet '{selected_sheet}'. Please check the file format or if names are in the expected header row.")
@@ -199,14 +313,16 @@ if uploaded_file is not None:
                 st.header("Step 4: Generate and Download")
                 if st.button(f"Generate Calendar for {selected_name}"):
                     with st.spinner("Processing your file..."):
-                        final_df, date_info = process_roster(file_bytes, selected_sheet, selected_name, uploaded_file.name)
+                        final_df, date_info = process_roster(raw_bytes, sheet_info, selected_name, uploaded_file.name)
 
                     if final_df is not None and date_info is not None:
                         st.success("✅ Your calendar file is ready!")
                         st.dataframe(final_df)
 
-                        # Convert DataFrame to CSV string, then encode to bytes
-                        csv_bytes = final_df.to_csv(index=False).encode('utf-8')
+                        # Write the DataFrame straight to UTF-8 CSV bytes, without building an intermediate str
+                        csv_buffer = io.BytesIO()
+                        pacsv.write_csv(pa.Table.from_pandas(final_df, preserve_index=False), csv_buffer)
+                        csv_bytes = csv_buffer.getvalue()
 
                         # Create the download button with correct month and year from filename
                         output_filename = f"{selected_name.replace(' ', '_')}-{selected_sheet}-{filename_month_name}-{filename_year_str}-Calendar.csv"